@@ -2,23 +2,89 @@ from flask import Flask, render_template, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
-from PIL import Image
-import uuid
-import base64
+from PIL import Image, features
+import secrets
+try:
+    import pybase64
+except ImportError:
+    import base64 as pybase64
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
 import io
-from database import init_database, add_submission, get_random_submission, get_submission_count
+import atexit
+import contextlib
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from database import (
+    INSTANCE_DIR, init_database, add_submission, get_random_submission, get_submission_count,
+    set_submission_status, drop_submission_image, get_pending_submissions
+)
 
 
+# Handlers only enqueue records; a listener thread does the blocking stderr
+# writes. Configured before the app exists so Flask skips its default handler.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
 app = Flask(__name__)
 CORS(app)  
 
 
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Raw images waiting for the background worker; kept on the instance volume so
+# a restart can pick them up, and outside UPLOAD_FOLDER so they are never served
+app.config['STAGING_FOLDER'] = os.path.join(INSTANCE_DIR, 'staging')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  
+app.config['PNG_COMPRESS_LEVEL'] = int(os.environ.get('PNG_COMPRESS_LEVEL', 1))
+# Only enable behind a proxy that honours X-Sendfile, otherwise images are served empty
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true')
 ALLOWED_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+RESAMPLE = Image.Resampling[os.environ.get('PILLOW_RESAMPLING_FILTER', 'BILINEAR').upper()]
 
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['STAGING_FOLDER'], exist_ok=True)
+
+# Pillow releases the GIL while decoding/resizing/encoding, so threads are enough
+executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def save_png(image, file_path):
+    """Encode image as PNG in memory and write it out with a single write"""
+    # OpenCV's libpng encoder is faster than Pillow's. RGB/L uploads get here
+    # (canvases are palette images and take the Pillow path below); the RLE
+    # strategy skips the full LZ77 match search but still collapses the flat
+    # backgrounds of uploaded doodles, which Huffman-only would not.
+    if cv2 is not None and image.mode in ('RGB', 'L'):
+        arr = np.asarray(image)
+        if image.mode == 'RGB':
+            arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+        ok, buf = cv2.imencode('.png', arr, [
+            cv2.IMWRITE_PNG_COMPRESSION, app.config['PNG_COMPRESS_LEVEL'],
+            cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE,
+        ])
+        if ok:
+            with open(file_path, 'wb') as f:
+                f.write(buf)
+            return
+    
+    buf = io.BytesIO()
+    image.save(buf, 'PNG', compress_level=app.config['PNG_COMPRESS_LEVEL'])
+    with open(file_path, 'wb') as f:
+        f.write(buf.getbuffer())
+
+def has_image_signature(header):
+    """Cheap magic-byte check so obvious non-images never reach PIL"""
+    return header.startswith(IMAGE_SIGNATURES)
 
 def validate_image_file(file):
     """Security File Validation"""
@@ -30,49 +96,54 @@ def validate_image_file(file):
         return False, "Invalid file type. Only PNG, JPG, and GIF allowed"
     
    
-    file_content = file.read()
-    file.seek(0)  
+    file.stream.seek(0, os.SEEK_END)
+    file_size = file.stream.tell()
+    file.stream.seek(0)  
+    
+    
+    if file_size > 5 * 1024 * 1024:  # 5MB
+        return False, "File too large. Maximum size is 5MB"
+    
+    
+    header = file.stream.read(12)
+    file.stream.seek(0)
+    if not has_image_signature(header):
+        return False, "File is not a recognized image"
     
    
+    # Image.open only parses the header off the stream; pixel data is read
+    # (and corrupt data raises) when the background worker decodes it
     try:
-        with Image.open(io.BytesIO(file_content)) as img:
-            img.verify()  
-        
-        file.seek(0)  
-        with Image.open(file) as img:
-            if img.format.lower() not in ['png', 'jpeg', 'gif']:
+        with Image.open(file.stream) as img:
+            if img.format is None or img.format.lower() not in ['png', 'jpeg', 'gif']:
                 return False, "File format not supported"
-            
     except Exception:
         return False, "File is not a valid image"
     
-    
-    if len(file_content) > 5 * 1024 * 1024:  # 5MB
-        return False, "File too large. Maximum size is 5MB"
-    
-    file.seek(0)  
+    file.stream.seek(0)
     return True, "Valid image"
 
-def sanitize_and_process_image(file):
-    """Sanitize and process uploaded image"""
+def sanitize_and_process_image(image, unique_filename):
+    """Sanitize and process an uploaded image, saving it as unique_filename"""
     try:
         
-        image = Image.open(file)
-        
+        # Let libjpeg decode straight to a reduced scale
+        if image.format == 'JPEG':
+            image.draft('RGB', (800, 800))
         
         if image.mode not in ('RGB', 'L'):  
             image = image.convert('RGB')
         
        
         max_size = (800, 800)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+        if image.width > max_size[0] or image.height > max_size[1]:
+            image.thumbnail(max_size, RESAMPLE)
         
        
-        unique_filename = f"{uuid.uuid4()}.png"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         
         
-        image.save(file_path, 'PNG', optimize=True)
+        save_png(image, file_path)
         
         return unique_filename, None
         
@@ -83,52 +154,118 @@ def allowed_file(filename):
     """Check if uploaded file has allowed extension"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_canvas_drawing(canvas_data):
-    """Process and save canvas drawing from base64 data"""
+def decode_canvas_drawing(canvas_data):
+    """Decode and validate canvas drawing from base64 data"""
+    if not canvas_data or not canvas_data.startswith('data:image'):
+        return None, "Invalid canvas data"
+    
+   
+    # Slice past the data URL prefix without split()'s list + second copy
+    canvas_data = canvas_data[canvas_data.find(',') + 1:]
+    
+  
+    try:
+        image_data = pybase64.b64decode(canvas_data, validate=False)
+    except Exception:
+        return None, "Invalid base64 data"
+    
+    
+    if not has_image_signature(image_data[:12]):
+        return None, "Canvas data is not a valid image"
+    
+    try:
+        with Image.open(io.BytesIO(image_data)):
+            pass
+    except Exception:
+        return None, "Canvas data is not a valid image"
+    
+    return image_data, None
+
+def process_canvas_drawing(image, unique_filename):
+    """Process and save canvas drawing as unique_filename"""
     try:
-        
-        if not canvas_data or not canvas_data.startswith('data:image'):
-            return None, "Invalid canvas data"
-        
-       
-        canvas_data = canvas_data.split(',')[1]
-        
-      
-        try:
-            image_data = base64.b64decode(canvas_data)
-        except Exception:
-            return None, "Invalid base64 data"
-        
-        
-        try:
-            with Image.open(io.BytesIO(image_data)) as img:
-                img.verify()  
-                
-            
-            image = Image.open(io.BytesIO(image_data))
-        except Exception:
-            return None, "Canvas data is not a valid image"
-        
         
         if image.mode != 'RGB':
             image = image.convert('RGB')
         
         
-        unique_filename = f"{uuid.uuid4()}.png"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         
        
         max_size = (800, 800)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+        if image.width > max_size[0] or image.height > max_size[1]:
+            image.thumbnail(max_size, RESAMPLE)
+        
+        # Doodles use a handful of ink colors; an 8-bit palette is a third of
+        # the RGB pixel data for deflate to chew through and to store
+        image = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
         
         
-        image.save(file_path, 'PNG', optimize=True)
+        save_png(image, file_path)
         
         return unique_filename, None
         
     except Exception as e:
         return None, f"Error processing canvas: {str(e)}"
 
+# Staged files are named <filename>.<kind> so a restart knows how to finish them
+IMAGE_PROCESSORS = {
+    'canvas': process_canvas_drawing,
+    'upload': sanitize_and_process_image,
+}
+
+def stage_raw_image(write_raw, kind):
+    """Reserve a filename and stash the raw image bytes in staging for the worker"""
+    unique_filename = f"{secrets.token_hex(16)}.png"
+    tmp_path = os.path.join(app.config['STAGING_FOLDER'], f"{unique_filename}.{kind}")
+    write_raw(tmp_path)
+    return unique_filename, tmp_path
+
+def _finalize_image(kind, tmp_path, unique_filename, submission_id):
+    """Background job: re-encode a staged image and publish its submission"""
+    # Runs in the executor, whose future would swallow anything raised here
+    try:
+        error_message = None
+        try:
+            with Image.open(tmp_path) as image:
+                _, error_message = IMAGE_PROCESSORS[kind](image, unique_filename)
+        except Exception as e:
+            error_message = str(e)
+        
+        if error_message:
+            # Keep any text the user sent; only the image is lost
+            app.logger.error("Error finalizing submission %s: %s", submission_id, error_message)
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file_path)
+            drop_submission_image(submission_id)
+        else:
+            set_submission_status(submission_id, 'ready')
+        
+        # Only after the row is settled; a leftover file is swept at next startup
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+    except Exception:
+        app.logger.exception("Error finalizing submission %s", submission_id)
+
+def recover_pending_images():
+    """Re-queue images left pending by a previous process and clear orphaned staging files"""
+    staged = {}
+    for name in os.listdir(app.config['STAGING_FOLDER']):
+        unique_filename, _, kind = name.rpartition('.')
+        staged[unique_filename] = (kind, os.path.join(app.config['STAGING_FOLDER'], name))
+    
+    for submission_id, doodle_filename in get_pending_submissions():
+        kind, tmp_path = staged.pop(doodle_filename, (None, None))
+        if kind in IMAGE_PROCESSORS:
+            executor.submit(_finalize_image, kind, tmp_path, doodle_filename, submission_id)
+        else:
+            app.logger.error("Staged image for submission %s is missing", submission_id)
+            drop_submission_image(submission_id)
+    
+    for _, tmp_path in staged.values():
+        os.remove(tmp_path)
+
 def process_uploaded_file(file):
     """Process and save uploaded image file"""
     if not file or not allowed_file(file.filename):
@@ -136,19 +273,21 @@ def process_uploaded_file(file):
     
     
     file_extension = file.filename.rsplit('.', 1)[1].lower()
-    unique_filename = f"{uuid.uuid4()}.{file_extension}"
+    unique_filename = f"{secrets.token_hex(16)}.{file_extension}"
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
     
     
     try:
         image = Image.open(file)
+        if image.format == 'JPEG':
+            image.draft('RGB', (800, 800))
        
         max_size = (800, 800)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        image.save(file_path)
+        image.thumbnail(max_size, RESAMPLE)
+        image.save(file_path, compress_level=app.config['PNG_COMPRESS_LEVEL'])
         return unique_filename
-    except Exception as e:
-        print(f"Error processing uploaded image: {e}")
+    except Exception:
+        app.logger.exception("Error processing uploaded image")
         return None
 
 
@@ -176,17 +315,27 @@ def submit_content():
         uploaded_file = request.files.get('doodle_file')
         
         doodle_filename = None
-        error_message = None
+        tmp_path = None
+        kind = None
         
         
         if canvas_data and canvas_data != 'null' and uploaded_file and uploaded_file.filename:
             return jsonify({'error': 'Cannot submit both drawing and file upload. Choose one.'}), 400
         
         
+        # Only validation happens on the request thread; the slow
+        # decode/resize/encode runs in the executor once the row exists
         if canvas_data and canvas_data != 'null':
-            doodle_filename, error_message = process_canvas_drawing(canvas_data)
+            image_data, error_message = decode_canvas_drawing(canvas_data)
             if error_message:
                 return jsonify({'error': error_message}), 400
+            
+            def write_raw(path):
+                with open(path, 'wb') as f:
+                    f.write(image_data)
+            
+            kind = 'canvas'
+            doodle_filename, tmp_path = stage_raw_image(write_raw, kind)
         
        
         elif uploaded_file and uploaded_file.filename:
@@ -195,10 +344,8 @@ def submit_content():
             if not is_valid:
                 return jsonify({'error': validation_message}), 400
             
-            
-            doodle_filename, error_message = sanitize_and_process_image(uploaded_file)
-            if error_message:
-                return jsonify({'error': error_message}), 400
+            kind = 'upload'
+            doodle_filename, tmp_path = stage_raw_image(uploaded_file.save, kind)
         
         
         if not text_content and not doodle_filename:
@@ -214,9 +361,15 @@ def submit_content():
         
         submission_id = add_submission(
             text_content=text_content,
-            doodle_filename=doodle_filename
+            doodle_filename=doodle_filename,
+            status='pending' if doodle_filename else 'ready'
         )
         
+        if submission_id and doodle_filename:
+            executor.submit(_finalize_image, kind, tmp_path, doodle_filename, submission_id)
+        elif tmp_path:
+            os.remove(tmp_path)
+        
         if submission_id:
             return jsonify({
                 'success': True,
@@ -226,8 +379,8 @@ def submit_content():
         else:
             return jsonify({'error': 'Failed to save submission'}), 500
             
-    except Exception as e:
-        print(f"Error in submit_content: {e}")
+    except Exception:
+        app.logger.exception("Error in submit_content")
         return jsonify({'error': 'Something went wrong'}), 500
 
 @app.route('/api/scry', methods=['GET'])
@@ -237,18 +390,22 @@ def scry_orb():
         submission = get_random_submission()
         
         if submission:
-            return jsonify({
+            response = jsonify({
                 'success': True,
                 'submission': submission
             })
         else:
-            return jsonify({
+            response = jsonify({
                 'success': False,
                 'message': 'The orb is empty... no visions to see'
             })
+        
+        # Every scry must be a fresh random pick
+        response.cache_control.no_store = True
+        return response
             
-    except Exception as e:
-        print(f"Error in scry_orb: {e}")
+    except Exception:
+        app.logger.exception("Error in scry_orb")
         return jsonify({'error': 'The orb refuses to reveal its secrets'}), 500
 
 @app.route('/api/stats', methods=['GET'])
@@ -256,18 +413,29 @@ def get_stats():
     """API endpoint to get orb statistics"""
     try:
         count = get_submission_count()
-        return jsonify({
+        response = jsonify({
             'total_submissions': count
         })
-    except Exception as e:
-        print(f"Error getting stats: {e}")
+        
+        # The count only changes on submit, so pollers can revalidate cheaply;
+        # make_conditional compares If-None-Match weakly, as RFC 9110 requires
+        response.set_etag(str(count))
+        response.cache_control.public = True
+        response.cache_control.max_age = 5
+        return response.make_conditional(request)
+    except Exception:
+        app.logger.exception("Error getting stats")
         return jsonify({'error': 'Cannot read orb statistics'}), 500
 
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded doodle images"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Filenames are random 128-bit tokens and never rewritten, so browsers can keep them forever
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True, max_age=2592000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/')
 def index():
@@ -275,9 +443,17 @@ def index():
     return render_template('orb.html', total_submissions=get_submission_count())
 
 if __name__ == '__main__':
+    # Debug mode (reloader + debugger) only when FLASK_DEBUG is set
+    debug = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true')
+    
     init_database()
+    # The reloader runs this block in both the watcher and the serving child;
+    # only the child (WERKZEUG_RUN_MAIN) may finalize staged images
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN'):
+        recover_pending_images()
+    print(f"Pillow {Image.__version__} (libjpeg-turbo: {features.check_feature('libjpeg_turbo')})")
     print("dusting off orb...")
     
     import os
     port = int(os.environ.get('PORT', 5000))
-    app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(debug=debug, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -1,5 +1,8 @@
 import sqlite3
 import os
+import atexit
+import threading
+import logging
 from datetime import datetime
 
 # Use absolute path for Railway deployment
@@ -7,35 +10,112 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 INSTANCE_DIR = os.path.join(BASE_DIR, 'instance')
 DATABASE = os.path.join(INSTANCE_DIR, 'orb.db')
 
+logger = logging.getLogger(__name__)
+
+# One persistent connection per worker process, shared by its request threads.
+# The dev server spawns a thread per request, so a thread-local connection
+# would still be reopened on every request.
+_conn = None
+_conn_lock = threading.Lock()
+
+# In-memory count of ready submissions, loaded once and bumped on writes
+# (under _conn_lock). Only valid while every write goes through this module.
+_count = None
+
+# Hot-path statements, kept as constants so every call hands sqlite3 the
+# identical string and hits the connection's compiled-statement cache
+INSERT_SUBMISSION_SQL = '''
+    INSERT INTO submissions (text_content, doodle_filename, submission_type, status)
+    VALUES (?, ?, ?, ?)
+'''
+UPDATE_STATUS_SQL = 'UPDATE submissions SET status = ? WHERE id = ? AND status != ?'
+DROP_IMAGE_SQL = '''
+    UPDATE submissions
+    SET doodle_filename = NULL, submission_type = 'text', status = 'ready'
+    WHERE id = ? AND status = 'pending' AND COALESCE(text_content, '') != ''
+'''
+FAIL_PENDING_SQL = "UPDATE submissions SET status = 'failed' WHERE id = ? AND status = 'pending'"
+RANDOM_SUBMISSION_SQL = '''
+    SELECT id, text_content, doodle_filename, submission_type, timestamp
+    FROM submissions
+    WHERE id >= (ABS(RANDOM()) % (SELECT MAX(id) FROM submissions)) + 1
+      AND status = 'ready'
+    ORDER BY id
+    LIMIT 1
+'''
+FIRST_SUBMISSION_SQL = '''
+    SELECT id, text_content, doodle_filename, submission_type, timestamp
+    FROM submissions
+    WHERE status = 'ready'
+    ORDER BY id
+    LIMIT 1
+'''
+COUNT_SUBMISSIONS_SQL = "SELECT COUNT(*) FROM submissions WHERE status = 'ready'"
+
+def _get_conn():
+    """Return the persistent connection, opening it on first use (hold _conn_lock)"""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None)
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+        _conn.execute('PRAGMA temp_store=MEMORY')
+        _conn.execute('PRAGMA cache_size=-65536')  # 64 MB page cache
+        _conn.execute('PRAGMA mmap_size=268435456')  # read pages straight from a 256 MB mapping
+    return _conn
+
+@atexit.register
+def _close_conn():
+    """Close the persistent connection at interpreter exit"""
+    global _conn
+    with _conn_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
 def init_database():
     """Initialize the database and create tables if they don't exist"""
     # Create instance directory if it doesn't exist
     os.makedirs(INSTANCE_DIR, exist_ok=True)
-    
-    # Connect to database (creates file if doesn't exist)
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Create submissions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS submissions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            text_content TEXT,
-            doodle_filename TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            submission_type TEXT CHECK(submission_type IN ('text', 'doodle', 'both'))
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+
+    with _conn_lock:
+        # Connect to database (creates file if doesn't exist)
+        cursor = _get_conn().cursor()
+
+        # Create submissions table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text_content TEXT,
+                doodle_filename TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                submission_type TEXT CHECK(submission_type IN ('text', 'doodle', 'both')),
+                status TEXT NOT NULL DEFAULT 'ready' CHECK(status IN ('pending', 'ready', 'failed'))
+            )
+        ''')
+
+        # Databases created before background image processing lack the status column
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(submissions)')]
+        if 'status' not in columns:
+            cursor.execute('''
+                ALTER TABLE submissions
+                ADD COLUMN status TEXT NOT NULL DEFAULT 'ready' CHECK(status IN ('pending', 'ready', 'failed'))
+            ''')
+
+        # Larger pages mean fewer page lookups per read. page_size can't change
+        # in WAL mode, so rebuild the file once in rollback mode and switch back.
+        if cursor.execute('PRAGMA page_size').fetchone()[0] != 8192:
+            cursor.execute('PRAGMA journal_mode=DELETE')
+            cursor.execute('PRAGMA page_size=8192')
+            cursor.execute('VACUUM')
+            cursor.execute('PRAGMA journal_mode=WAL')
+
+    refresh_count()
     print(f"Database initialized at: {DATABASE}")
 
-def add_submission(text_content=None, doodle_filename=None):
+def add_submission(text_content=None, doodle_filename=None, status='ready'):
     """Add a new submission to the database"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
+    global _count
     if text_content and doodle_filename:
         submission_type = 'both'
     elif text_content:
@@ -43,35 +123,62 @@ def add_submission(text_content=None, doodle_filename=None):
     elif doodle_filename:
         submission_type = 'doodle'
     else:
-        return None  
-    
-    cursor.execute('''
-        INSERT INTO submissions (text_content, doodle_filename, submission_type)
-        VALUES (?, ?, ?)
-    ''', (text_content, doodle_filename, submission_type))
-    
-    submission_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    print(f"Added submission {submission_id} of type {submission_type}")
+        return None
+
+    with _conn_lock:
+        cursor = _get_conn().execute(
+            INSERT_SUBMISSION_SQL, (text_content, doodle_filename, submission_type, status)
+        )
+
+        submission_id = cursor.lastrowid
+        if status == 'ready' and _count is not None:
+            _count += 1
+
+    logger.info("Added submission %s of type %s", submission_id, submission_type)
     return submission_id
 
+def set_submission_status(submission_id, status):
+    """Update the processing status of a submission"""
+    global _count
+    with _conn_lock:
+        cursor = _get_conn().execute(UPDATE_STATUS_SQL, (status, submission_id, status))
+        if status == 'ready' and cursor.rowcount and _count is not None:
+            _count += 1
+
+def drop_submission_image(submission_id):
+    """Publish a pending submission without its failed image, or mark it failed if it has no text"""
+    global _count
+    with _conn_lock:
+        conn = _get_conn()
+        cursor = conn.execute(DROP_IMAGE_SQL, (submission_id,))
+        if cursor.rowcount:
+            if _count is not None:
+                _count += 1
+        else:
+            conn.execute(FAIL_PENDING_SQL, (submission_id,))
+
+def get_pending_submissions():
+    """Get (id, doodle_filename) for submissions still waiting on image processing"""
+    with _conn_lock:
+        return _get_conn().execute(
+            "SELECT id, doodle_filename FROM submissions WHERE status = 'pending'"
+        ).fetchall()
+
 def get_random_submission():
     """Get a random submission from the database"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, text_content, doodle_filename, submission_type, timestamp
-        FROM submissions
-        ORDER BY RANDOM()
-        LIMIT 1
-    ''')
-    
-    result = cursor.fetchone()
-    conn.close()
-    
+    with _conn_lock:
+        conn = _get_conn()
+        # Jump to a random point in the id range instead of sorting the whole
+        # table by RANDOM(); both lookups walk the primary key index
+        result = conn.execute(RANDOM_SUBMISSION_SQL).fetchone()
+
+        # Landed past the last ready row (gaps from pending/failed rows): re-roll
+        # once so the first row doesn't absorb the gap, then wrap around
+        if result is None:
+            result = conn.execute(RANDOM_SUBMISSION_SQL).fetchone()
+        if result is None:
+            result = conn.execute(FIRST_SUBMISSION_SQL).fetchone()
+
     if result:
         return {
             'id': result[0],
@@ -82,16 +189,19 @@ def get_random_submission():
         }
     return None
 
+def refresh_count():
+    """Reload the cached submission count from the database"""
+    global _count
+    with _conn_lock:
+        _count = _get_conn().execute(COUNT_SUBMISSIONS_SQL).fetchone()[0]
+
+    return _count
+
 def get_submission_count():
     """Get total number of submissions"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM submissions')
-    count = cursor.fetchone()[0]
-    
-    conn.close()
-    return count
+    if _count is None:
+        return refresh_count()
+    return _count
 
 def check_database_status():
     """Debug function to check database status"""
@@ -107,4 +217,4 @@ def check_database_status():
 if __name__ == '__main__':
     init_database()
     check_database_status()
-    print("Database initialized successfully!")
\ No newline at end of file
+    print("Database initialized successfully!")